@@ -5,18 +5,220 @@ Run this on Replit to handle voice interview requests
 CRITICAL: Audio files are NEVER stored - only transcribed text is saved.
 """
 
-from flask import Flask, request, jsonify, Response
-from flask_cors import CORS
-import os
+from flask import Flask, request, Response, stream_with_context
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException
+from concurrent.futures import ThreadPoolExecutor
 import base64
-from dialogflow_voice import (
-    start_voice_interview_session,
-    detect_intent_with_audio
-)
-from dialogflow_interview import score_interview
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+
+# orjson parses and serializes several times faster than stdlib json;
+# fall back to stdlib when it isn't installed.
+try:
+    import orjson
+
+    def parse_json(raw):
+        return orjson.loads(raw)
+
+    def json_response(obj, status=200):
+        return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+except ImportError:
+    import json
+
+    def parse_json(raw):
+        return json.loads(raw)
+
+    def json_response(obj, status=200):
+        return Response(json.dumps(obj), status=status, mimetype='application/json')
+
+# Stream audio to the client in slabs instead of buffering one giant
+# base64 string inside a JSON body.
+AUDIO_CHUNK_SIZE = 16384
+
+# Offload long Dialogflow round-trips so a worker isn't pinned for the
+# whole STT+NLU+TTS pipeline when the client opts into polling.
+EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
+# In-flight/finished jobs: job_id -> (expires_at, future)
+JOB_TTL_SECONDS = 300
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+# Scoring is expensive (a multi-second Gemini call) and the frontend may
+# poll or retry, so serve repeats from memory: session_id -> (expires_at,
+# score_report). Per-session locks coalesce concurrent requests into one
+# Gemini call instead of a thundering herd.
+SCORE_TTL_SECONDS = 3600
+_score_cache = {}
+_score_cache_lock = threading.Lock()
+_score_locks = {}
+
+# Clients retry the same utterance on network hiccups; an identical
+# (session, audio) replay within the TTL is served from memory instead of
+# a second full Dialogflow round trip. End-of-interview turns are never
+# cached so a replayed farewell can't mask a fresh session.
+REPLAY_TTL_SECONDS = 30
+REPLAY_CACHE_MAX = 1024
+_replay_cache = {}
+_replay_lock = threading.Lock()
+
+
+def _replay_key(session_id, audio_data):
+    # BLAKE2 digests large buffers faster than SHA-2 and 16 bytes is
+    # plenty for a retry-window cache key.
+    return (session_id, hashlib.blake2b(audio_data, digest_size=16).digest())
+
+
+def _cached_replay(key):
+    with _replay_lock:
+        entry = _replay_cache.get(key)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        _replay_cache.pop(key, None)
+        return None
+
+
+def _store_replay(key, result):
+    now = time.time()
+    with _replay_lock:
+        for stale in [k for k, (expires, _) in _replay_cache.items() if expires < now]:
+            del _replay_cache[stale]
+        if len(_replay_cache) < REPLAY_CACHE_MAX:
+            _replay_cache[key] = (now + REPLAY_TTL_SECONDS, result)
+
+
+def _score_lock_for(session_id):
+    with _score_cache_lock:
+        lock = _score_locks.get(session_id)
+        if lock is None:
+            lock = _score_locks[session_id] = threading.Lock()
+        return lock
+
+
+def _cached_score(session_id):
+    with _score_cache_lock:
+        entry = _score_cache.get(session_id)
+        if entry and entry[0] > time.time():
+            return entry[1]
+        _score_cache.pop(session_id, None)
+        return None
+
+
+def _store_score(session_id, score_report):
+    """Cache a score report, pruning expired sessions and their locks."""
+    now = time.time()
+    with _score_cache_lock:
+        for stale in [s for s, (expires, _) in _score_cache.items() if expires < now]:
+            del _score_cache[stale]
+            _score_locks.pop(stale, None)
+        _score_cache[session_id] = (now + SCORE_TTL_SECONDS, score_report)
+        # The coalescing lock has done its job once the report is cached;
+        # threads already waiting on it re-check the cache and hit.
+        _score_locks.pop(session_id, None)
+
+
+def _store_job(future):
+    """Register a future under a fresh job id, pruning expired entries."""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with _jobs_lock:
+        for stale_id in [j for j, (expires, _) in _jobs.items() if expires < now]:
+            del _jobs[stale_id]
+        _jobs[job_id] = (now + JOB_TTL_SECONDS, future)
+    return job_id
+
+
+# The constant part of every audio response, built once instead of as a
+# fresh dict per request.
+BASE_AUDIO_HEADERS = Headers([
+    ('Content-Type', 'audio/mpeg'),
+    ('Content-Disposition', 'inline; filename="response.mp3"'),
+])
+
+
+def _stream_audio(audio_bytes, extra_headers):
+    """Stream MP3 bytes with the shared base headers plus per-call extras"""
+    def generate():
+        for i in range(0, len(audio_bytes), AUDIO_CHUNK_SIZE):
+            yield audio_bytes[i:i + AUDIO_CHUNK_SIZE]
+
+    headers = BASE_AUDIO_HEADERS.copy()
+    headers['Content-Length'] = str(len(audio_bytes))
+    for name, value in extra_headers:
+        headers[name] = value
+    # Content-Length is already known, so don't let Flask iterate the body
+    # to compute it.
+    return Response(stream_with_context(generate()), headers=headers,
+                    direct_passthrough=True)
+
+
+def _header_safe(text):
+    """
+    Make arbitrary agent/user text safe for an HTTP header value
+
+    Strips CR/LF (header injection) and pre-encodes non-ASCII once so
+    Werkzeug never hits its slow latin-1 re-encoding path. No truncation:
+    agent questions and transcripts are user-visible and must arrive
+    intact, as they did in the old JSON body.
+    """
+    return (text or '').replace('\r', ' ').replace('\n', ' ') \
+        .encode('ascii', 'backslashreplace').decode('ascii')
+
+
+def _audio_stream_response(result):
+    """Build the streaming audio/mpeg response for a detect-intent result"""
+    return _stream_audio(result.get("audio_response") or b"", [
+        ('X-Response-Text', _header_safe(result["agent_response_text"])),
+        ('X-Response-Transcript', _header_safe(result["user_transcript"])),
+        ('X-Response-IsEnd', 'true' if result["is_end"] else 'false'),
+    ])
+
+logger = logging.getLogger(__name__)
+# setLevel only accepts the upper-case level names; normalize so
+# LOG_LEVEL=debug doesn't raise ValueError at import and kill the worker.
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
 
 app = Flask(__name__)
-CORS(app)  # Enable CORS for frontend requests
+
+# ~60s of WebM Opus is well under 10MB; anything bigger is a runaway or
+# malicious upload and gets a 413 before it can exhaust worker memory.
+app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024
+
+# CORS without flask-cors: the allowed-origin set is precomputed from the
+# environment (comma-separated), defaulting to '*' to match the old
+# CORS(app) behavior, and the check is a frozenset lookup instead of
+# per-request regex matching.
+ALLOWED_ORIGINS = frozenset(
+    o.strip() for o in os.environ.get('ALLOWED_ORIGINS', '*').split(',') if o.strip()
+)
+_ALLOW_ANY_ORIGIN = '*' in ALLOWED_ORIGINS
+_CORS_EXPOSE_HEADERS = ('X-Response-Text, X-Response-Transcript, '
+                        'X-Response-IsEnd, Content-Length')
+
+
+# Probes hit /health at high frequency; serve one precomputed Response
+# and skip the CORS hook entirely for it.
+HEALTH_RESPONSE = Response(b'{"status":"healthy"}', mimetype='application/json')
+
+
+@app.after_request
+def add_cors_headers(response):
+    if request.path == '/health':
+        return response
+    origin = request.headers.get('Origin')
+    if origin and (_ALLOW_ANY_ORIGIN or origin in ALLOWED_ORIGINS):
+        response.headers['Access-Control-Allow-Origin'] = '*' if _ALLOW_ANY_ORIGIN else origin
+        response.headers['Access-Control-Expose-Headers'] = _CORS_EXPOSE_HEADERS
+        if request.method == 'OPTIONS':
+            response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+            response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+            response.headers['Access-Control-Max-Age'] = '3600'
+    return response
 
 @app.route('/api/voice-interview/start', methods=['POST'])
 def start_voice_interview():
@@ -24,31 +226,45 @@ def start_voice_interview():
     Start a voice interview session
     """
     try:
-        data = request.json
+        # Imported lazily so the server binds (and /health answers) before
+        # the google-cloud SDKs finish loading; sys.modules caches it after
+        # the first call.
+        from dialogflow_voice import start_voice_interview_session
+
+        data = parse_json(request.get_data(cache=False))
         session_id = data.get("session_id")
         role = data.get("role")
         resume_text = data.get("resumeText", "")
         difficulty = data.get("difficulty", "Medium")
         
         if not session_id:
-            return jsonify({"error": "session_id is required"}), 400
+            return json_response({"error": "session_id is required"}, 400)
         if not role:
-            return jsonify({"error": "role is required"}), 400
+            return json_response({"error": "role is required"}, 400)
         
         result = start_voice_interview_session(session_id, role, resume_text, difficulty)
-        
-        # Encode audio to base64 for JSON response
+
+        # This endpoint keeps the JSON/base64 contract: the Node proxy does
+        # an unconditional response.json() on it (unlike send-audio, which
+        # branches on content type), so a raw MP3 body would break every
+        # start through the proxy.
         audio_base64 = base64.b64encode(result["audio_response"]).decode('utf-8') if result.get("audio_response") else ""
-        
-        return jsonify({
+
+        return json_response({
             "sessionId": result["session_id"],
             "audioResponse": audio_base64,
             "audioFormat": "mp3",
             "agentResponseText": result["agent_response_text"]
         })
     
+    except HTTPException:
+        # Werkzeug raises its errors lazily when the handler first touches
+        # the body (e.g. the 413 from MAX_CONTENT_LENGTH); re-raise so they
+        # keep their status instead of collapsing into a generic 500.
+        raise
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        logger.exception("start_voice_interview failed")
+        return json_response({"error": str(e)}, 500)
 
 @app.route('/api/voice-interview/send-audio', methods=['POST'])
 @app.route('/api/voice-interview', methods=['POST'])
@@ -59,51 +275,127 @@ def send_audio():
     CRITICAL: Audio is NOT stored - only transcribed text is saved.
     """
     try:
+        from dialogflow_voice import detect_intent_with_audio
+
         # Get audio file from request
         if 'audio' not in request.files:
-            return jsonify({"error": "No audio file provided"}), 400
+            return json_response({"error": "No audio file provided"}, 400)
         
         audio_file = request.files['audio']
         session_id = request.form.get('session_id')
         
         if not session_id:
-            return jsonify({"error": "session_id is required"}), 400
-        
+            return json_response({"error": "session_id is required"}, 400)
+
+        # Kick off the last_agent_question lookup as early as the handler
+        # allows. session_id comes from the form, and touching request.form
+        # (or request.files above) has already parsed the full multipart
+        # body, so the only work left to overlap is the buffer copy and
+        # replay-hash below - a small window, not the upload drain itself.
+        from dialogflow_interview import get_from_database
+        last_question_future = EXECUTOR.submit(
+            get_from_database, session_id, "last_agent_question")
+
         # Read audio data (this is temporary, will be discarded after transcription)
-        audio_data = audio_file.read()
+        # Browsers almost never set a per-part Content-Length, and the
+        # request-level one covers the whole multipart body, so only take
+        # the preallocated readinto path when the part itself declares its
+        # size; otherwise .read() on the spooled file is already a single
+        # exact-size copy.
+        declared_length = audio_file.content_length or 0
+        if declared_length > 0:
+            buf = bytearray(declared_length)
+            bytes_read = audio_file.stream.readinto(buf)
+            audio_data = bytes(buf) if bytes_read == declared_length \
+                else bytes(memoryview(buf)[:bytes_read])
+        else:
+            audio_data = audio_file.read()
         
         # Audio data is temporary - only transcribed text is stored
+
+        # Encoding is negotiated by the client: a browser capturing raw PCM
+        # (AudioWorklet) sends AUDIO_ENCODING_LINEAR_16 so Dialogflow skips
+        # the WebM demux + Opus decode; everything else falls back to the
+        # historical Opus default. Field names match what the Node proxy
+        # forwards (routes.ts sends audioEncoding/sampleRate).
+        audio_encoding = request.form.get('audioEncoding', 'AUDIO_ENCODING_WEBM_OPUS')
+        sample_rate = int(request.form.get('sampleRate', 24000))
+
+        # Serve identical retries of the same utterance from the replay
+        # cache - no second Dialogflow round trip, no duplicate transcript
+        # entry.
+        replay_key = _replay_key(session_id, audio_data)
+        cached_result = _cached_replay(replay_key)
+        if cached_result is not None:
+            return _audio_stream_response(cached_result)
         
-        # Get last agent question for transcript saving
-        from dialogflow_interview import get_from_database
+        # Last agent question is needed for transcript saving
         last_agent_question = None
         try:
-            last_agent_question = get_from_database(session_id, "last_agent_question")
-        except:
-            pass
+            last_agent_question = last_question_future.result()
+        except Exception:
+            logger.debug("last_agent_question lookup failed for %s", session_id, exc_info=True)
         
+        # Clients that poll instead of holding the connection open get a
+        # 202 + job id; the Dialogflow pipeline runs on the executor.
+        if request.form.get('async') == 'true':
+            future = EXECUTOR.submit(
+                detect_intent_with_audio,
+                session_id=session_id,
+                audio_data=audio_data,
+                audio_encoding=audio_encoding,
+                sample_rate=sample_rate,
+                last_agent_question=last_agent_question
+            )
+            return json_response({"jobId": _store_job(future)}, 202)
+
         # Detect intent with audio
         result = detect_intent_with_audio(
             session_id=session_id,
             audio_data=audio_data,
-            audio_encoding="AUDIO_ENCODING_WEBM_OPUS",
-            sample_rate=24000,
+            audio_encoding=audio_encoding,
+            sample_rate=sample_rate,
             last_agent_question=last_agent_question
         )
-        
-        # Encode audio to base64
-        audio_base64 = base64.b64encode(result["audio_response"]).decode('utf-8') if result.get("audio_response") else ""
-        
-        return jsonify({
-            "audioResponse": audio_base64,
-            "audioFormat": "mp3",
-            "agentResponseText": result["agent_response_text"],
-            "userTranscript": result["user_transcript"],
-            "isEnd": result["is_end"]
-        })
+
+        if not result.get("is_end"):
+            _store_replay(replay_key, result)
+
+        # Stream the raw MP3 bytes instead of base64-encoding them into a
+        # JSON wrapper - avoids the 33% size bloat and a full-buffer copy.
+        # Metadata travels in X-Response-* headers.
+        return _audio_stream_response(result)
     
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("send_audio failed")
+        return json_response({"error": str(e)}, 500)
+
+@app.route('/api/voice-interview/result/<job_id>', methods=['GET'])
+def get_audio_result(job_id):
+    """
+    Poll for the result of an async send-audio job
+    """
+    with _jobs_lock:
+        entry = _jobs.get(job_id)
+    if entry is None:
+        return json_response({"error": "Unknown or expired job"}, 404)
+
+    _, future = entry
+    if not future.done():
+        return json_response({"status": "pending"}, 202)
+
+    with _jobs_lock:
+        _jobs.pop(job_id, None)
+
+    try:
+        result = future.result()
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        logger.exception("async send_audio job %s failed", job_id)
+        return json_response({"error": str(e)}, 500)
+
+    return _audio_stream_response(result)
 
 @app.route('/api/voice-interview/score', methods=['POST'])
 def score_interview_endpoint():
@@ -111,25 +403,41 @@ def score_interview_endpoint():
     Score the interview using Gemini AI
     """
     try:
-        data = request.json
+        from dialogflow_interview import score_interview
+
+        data = parse_json(request.get_data(cache=False))
         session_id = data.get("session_id")
         
         if not session_id:
-            return jsonify({"error": "session_id is required"}), 400
-        
-        score_report = score_interview(session_id)
-        
-        return jsonify(score_report)
+            return json_response({"error": "session_id is required"}, 400)
+
+        score_report = _cached_score(session_id)
+        if score_report is None:
+            with _score_lock_for(session_id):
+                # Re-check under the lock - a concurrent request may have
+                # just finished scoring this session.
+                score_report = _cached_score(session_id)
+                if score_report is None:
+                    score_report = score_interview(session_id)
+                    _store_score(session_id, score_report)
+
+        return json_response(score_report)
     
+    except HTTPException:
+        raise
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        logger.exception("score_interview failed")
+        return json_response({"error": str(e)}, 500)
 
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
-    return jsonify({"status": "healthy"})
+    return HEALTH_RESPONSE
 
 if __name__ == '__main__':
+    # Development only - production should run under gunicorn with gevent
+    # workers (see gunicorn_conf.py) so concurrent interviews don't
+    # serialize behind Werkzeug's single-threaded dev server.
     # Default to port 5001 to avoid conflict with Node.js server on port 5000
     port = int(os.environ.get('PORT', 5001))
     # Production mode: debug=False for security
@@ -0,0 +1,36 @@
+"""
+Gunicorn configuration for the voice interview API.
+
+Run with: gunicorn -c gunicorn_conf.py app:app
+
+The workload is I/O-bound (Dialogflow STT/TTS round-trips take hundreds
+of ms each), so gevent workers let one process serve many concurrent
+interviews instead of serializing them behind Werkzeug's dev server.
+The gevent worker monkey-patches the stdlib on boot; grpc's C-core does
+its own I/O and ignores that patching, so post_fork installs grpc's
+gevent shim - without it every Dialogflow/Firestore RPC would block the
+worker's hub (and grpc under an unpatched gevent is a known deadlock
+risk).
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5001)}"
+
+worker_class = "gevent"
+workers = 2 * multiprocessing.cpu_count() + 1
+worker_connections = 1000
+keepalive = 30
+
+
+def post_fork(server, worker):
+    # Must run before any gRPC channel exists; the app imports the
+    # google-cloud SDKs lazily inside handlers, so post_fork is early
+    # enough.
+    try:
+        import grpc.experimental.gevent as grpc_gevent
+    except ImportError:
+        server.log.warning("grpc not installed; skipping gevent shim")
+        return
+    grpc_gevent.init_gevent()